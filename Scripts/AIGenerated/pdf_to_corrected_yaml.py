@@ -6,74 +6,105 @@ Converts Sanskrit PDF to YAML using OCR, corrects errors with Claude, and enrich
 
 import sys
 import argparse
+import asyncio
+import hashlib
+import os
+import random
+import re
+import sqlite3
 from pathlib import Path
 import yaml
+from yaml import SafeDumper
 import json
-from anthropic import AnthropicVertex
+from anthropic import (AsyncAnthropic, AsyncAnthropicVertex, Timeout, APIStatusError,
+                       APIConnectionError)
+from tenacity import retry, retry_if_exception, wait_exponential, stop_after_attempt
+from tqdm import tqdm
+
+try:
+    # orjson parses Claude's JSON responses several times faster; its
+    # JSONDecodeError subclasses json.JSONDecodeError
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Import functions from existing scripts
-from pdf_to_yaml import pdf_to_text, extract_slokas, create_yaml_output
+from pdf_to_yaml import (pdf_to_text, iter_page_texts, extract_slokas, iter_slokas,
+                         create_yaml_output)
 
+MODEL = "claude-haiku-4-5@20251001"
 
-def correct_sloka_with_claude(sloka_text, client):
-    """
-    Use Claude API (via Vertex AI) to correct OCR errors in a Sanskrit sloka
+# Output budgets sized from the existing Output/ YAML files: slokas are at
+# most a few hundred characters, and the p95 corrected-sloka-plus-entries JSON
+# is ~1.4k characters (roughly 700 tokens of Devanagari and JSON punctuation)
+CORRECTION_MAX_TOKENS = 256
+PROCESS_MAX_TOKENS = 1024
 
-    Args:
-        sloka_text: The sloka text with potential OCR errors
-        client: Anthropic Vertex AI client
+# Slokas sent together in one request, so the instructions and the request
+# round trip are paid once per group; sized to keep a typical request (input
+# plus output) within ~3k tokens, where Haiku responds fastest
+CORRECTION_GROUP_SIZE = 10
+PROCESS_GROUP_SIZE = 3
 
-    Returns:
-        Corrected sloka text
-    """
-    prompt = f"""You are a Sanskrit scholar expert in classical Sanskrit texts, particularly kosha (synonym dictionaries) like Amarakosha and Vaijayanti Kosha.
+# A stalled request should free its worker long before the SDK's 10 minute
+# default. Responses are not streamed, so each request's read timeout also
+# allows for generating its whole output budget at a conservative rate
+# (Sonnet is slower than Haiku); otherwise a long group response would time
+# out, and be retried and billed, on every attempt
+REQUEST_TIMEOUT = Timeout(60.0, connect=5.0)
+MIN_OUTPUT_TOKENS_PER_SECOND = 20
+
+# A sloka made only of Devanagari letters and marks (no digits, Latin
+# letters or stray symbols), with a single danda and a closing double danda,
+# is shaped like a cleanly OCR'd verse (see --skip-clean)
+CLEAN_SLOKA_RE = re.compile(r"^[\u0900-\u0963\u0970-\u097F\u200C\u200D\s।]+॥$")
+CLEAN_SLOKA_MAX_LENGTH = 120
+
+# Fixed seed for --sample, so repeated runs compare prompts on the same slokas
+SAMPLE_SEED = 42
+
+# Any run of whitespace, including newlines, in a corrected sloka
+WS_RE = re.compile(r"\s+")
+
+# Markdown code fence (optionally tagged json) wrapped around a JSON response
+FENCE_RE = re.compile(r"^```(?:json)?\s*\n?(.*?)\n?```$", re.DOTALL)
 
-Below is a sloka extracted from OCR that may contain errors. Please correct any OCR errors while maintaining the exact meter and meaning. Common OCR errors in Devanagari include:
+# Static instructions are sent as system prompts so that only the sloka
+# changes between requests. They are marked for Anthropic's prompt cache, but
+# at their current size (well under 1k tokens) they are below the minimum
+# cacheable prefix of every model (4096 tokens for Haiku 4.5), so the marker
+# has no effect unless the instructions grow past that
+OCR_ERROR_HINTS = """Common OCR errors in Devanagari include:
 - ब/व confusion (ba/va)
 - ष/श confusion (ṣa/śa)
 - missing anusvara (ं) or visarga (ः)
 - ि/ी confusion (i/ī)
-- Incorrect matras
+- Incorrect matras"""
 
-Return ONLY the corrected sloka text, nothing else. Keep the same structure with । and ॥ dandas.
+CORRECTION_INSTRUCTIONS = f"""You are a Sanskrit scholar expert in classical Sanskrit texts, particularly kosha (synonym dictionaries) like Amarakosha and Vaijayanti Kosha.
 
-Original sloka:
-{sloka_text}
+You will be given a sloka extracted from OCR that may contain errors. Please correct any OCR errors while maintaining the exact meter and meaning. {OCR_ERROR_HINTS}
 
-Corrected sloka:"""
+Return ONLY the corrected sloka text, nothing else. Keep the same structure with । and ॥ dandas."""
 
-    try:
-        message = client.messages.create(
-            model="claude-3-5-haiku@20241022",
-            max_tokens=1024,
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
+# Correction of several numbered slokas in a single request
+CORRECTION_GROUP_INSTRUCTIONS = f"""You are a Sanskrit scholar expert in classical Sanskrit texts, particularly kosha (synonym dictionaries) like Amarakosha and Vaijayanti Kosha.
 
-        corrected = message.content[0].text.strip()
-        return corrected
-    except Exception as e:
-        print(f"Error correcting sloka: {e}")
-        return sloka_text  # Return original if correction fails
+You will be given numbered slokas extracted from OCR that may contain errors. Please correct any OCR errors in each sloka while maintaining the exact meter and meaning. {OCR_ERROR_HINTS}
 
+Keep the same structure with । and ॥ dandas. Return ONLY a JSON list of the corrected sloka texts, one string per numbered sloka in the same order (no markdown, no explanation)."""
 
-def parse_sloka_with_claude(sloka_text, client):
-    """
-    Use Claude to parse a kosha sloka and extract semantic structure
+# Correction and parsing in a single request (used unless enrichment is skipped)
+PROCESS_INSTRUCTIONS = f"""You are a Sanskrit scholar expert in classical Sanskrit texts, particularly kosha (synonym dictionaries) like Amarakosha and Vaijayanti Kosha.
 
-    Args:
-        sloka_text: The sloka to parse
-        client: Anthropic Vertex AI client
+You will be given a sloka extracted from OCR that may contain errors. First correct any OCR errors, then parse the corrected sloka and extract dictionary entries.
 
-    Returns:
-        Dictionary with parsed entries
-    """
-    prompt = f"""You are a Sanskrit kosha (synonym dictionary) expert. Parse this sloka from a classical Sanskrit kosha and extract dictionary entries.
+Step 1 - Correction:
+Correct any OCR errors while maintaining the exact meter and meaning. {OCR_ERROR_HINTS}
 
-Sloka: {sloka_text}
+Keep the same structure with । and ॥ dandas.
 
-Instructions:
+Step 2 - Parsing:
 1. Identify groups of synonyms (words with the same meaning)
 2. For each group, determine:
    - The headword (main word for that concept)
@@ -92,6 +123,7 @@ Rules:
 
 Return ONLY valid JSON in this exact format (no markdown, no explanation):
 {{
+  "corrected": "corrected sloka text",
   "entries": [
     {{
       "head": "prātipadika_of_headword",
@@ -106,6 +138,7 @@ Return ONLY valid JSON in this exact format (no markdown, no explanation):
 
 Example for: नागा बहुफणाः सर्पास्तेषां भोगवती पुरी॥
 {{
+  "corrected": "नागा बहुफणाः सर्पास्तेषां भोगवती पुरी॥",
   "entries": [
     {{
       "head": "सर्प",
@@ -125,45 +158,893 @@ Example for: नागा बहुफणाः सर्पास्तेष
       ]
     }}
   ]
-}}
+}}"""
 
-Now parse the given sloka and return JSON:"""
+# Correction and parsing of several numbered slokas in a single request
+PROCESS_GROUP_INSTRUCTIONS = PROCESS_INSTRUCTIONS + """
 
-    try:
-        message = client.messages.create(
-            model="claude-3-5-haiku@20241022",
-            max_tokens=2048,
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
+You may be given several numbered slokas. In that case correct and parse each sloka separately and return ONLY a JSON list with one object in the format above per numbered sloka, in the same order."""
+
+
+def cached_system(instructions):
+    """
+    Build a system prompt block marked for Anthropic prompt caching (only
+    effective once the instructions exceed the model's minimum cacheable
+    prompt length; see the note above OCR_ERROR_HINTS)
+
+    Args:
+        instructions: Static instruction text shared by every request
+
+    Returns:
+        List of system content blocks for messages.create
+    """
+    return [
+        {"type": "text", "text": instructions, "cache_control": {"type": "ephemeral"}}
+    ]
+
+
+class ResponseCache:
+    """
+    On-disk SQLite cache of Claude results, keyed by a SHA-256 hash of the
+    request parameters (model, max_tokens and full prompts; see
+    SlokaTask.cache_key), so editing a prompt or switching models
+    automatically invalidates old entries
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        # WAL lets several pipeline runs share the cache file
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT)"
+        )
+
+    @staticmethod
+    def key(params):
+        payload = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, params):
+        row = self.conn.execute(
+            "SELECT value FROM responses WHERE key = ?", (self.key(params),)
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, params, value):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, value) VALUES (?, ?)",
+            (self.key(params), value)
         )
+        self.conn.commit()
 
-        response_text = message.content[0].text.strip()
+    def close(self):
+        self.conn.close()
 
-        # Remove markdown code blocks if present
-        if response_text.startswith('```'):
-            lines = response_text.split('\n')
-            response_text = '\n'.join(lines[1:-1]) if len(lines) > 2 else response_text
-        if response_text.startswith('```json'):
-            response_text = response_text[7:]
-        if response_text.endswith('```'):
-            response_text = response_text[:-3]
 
-        response_text = response_text.strip()
+def looks_clean(sloka_text):
+    """
+    Cheap check for slokas whose OCR output is unlikely to need correction
+
+    This cannot catch confusions between Devanagari letters (e.g. ब/व), so it
+    is only used when --skip-clean is given.
+
+    Args:
+        sloka_text: The sloka text from OCR
+
+    Returns:
+        True if the sloka looks like a single clean verse
+    """
+    return (len(sloka_text) <= CLEAN_SLOKA_MAX_LENGTH
+            and CLEAN_SLOKA_RE.match(sloka_text) is not None
+            and sloka_text.count('।') == 1
+            and sloka_text.count('॥') == 1)
+
+
+def numbered_slokas(slokas):
+    """
+    Format slokas as a numbered list for a group request
+
+    Args:
+        slokas: List of sloka texts
+
+    Returns:
+        Text with one numbered sloka per line
+    """
+    return '\n'.join(f"{n}. {sloka}" for n, sloka in enumerate(slokas, 1))
+
+
+def strip_code_fence(response_text):
+    """
+    Remove a markdown code block wrapped around a response, if present
+
+    Args:
+        response_text: Raw response text from Claude
+
+    Returns:
+        Response text without the code fence
+    """
+    response_text = response_text.strip()
+    match = FENCE_RE.match(response_text)
+    if match:
+        response_text = match.group(1).strip()
+    return response_text
+
 
-        # Parse JSON
-        parsed = json.loads(response_text)
-        return parsed
+class SlokaTask:
+    """
+    One kind of Claude request about slokas: its prompts and output budget,
+    how Claude's answers are read and what a sloka gets when its request fails
+
+    Subclasses set the class attributes and implement check() and failed().
+    """
 
-    except json.JSONDecodeError as e:
-        print(f"Error parsing JSON from Claude: {e}")
-        return {"entries": []}
+    verb = None
+    instructions = None
+    group_instructions = None
+    answer_prompt = None
+    default_max_tokens = None
+    batch_prefix = None
+
+    def request(self, sloka_text, model=MODEL, max_tokens=None):
+        """
+        Build the Messages API parameters for one sloka
+
+        Args:
+            sloka_text: The sloka text with potential OCR errors
+            model: Claude model id
+            max_tokens: Output token budget (default depends on the task)
+
+        Returns:
+            Dictionary of keyword arguments for messages.create
+        """
+        return {
+            "model": model,
+            "max_tokens": max_tokens or self.default_max_tokens,
+            "system": cached_system(self.instructions),
+            "messages": [
+                {"role": "user",
+                 "content": f"Original sloka:\n{sloka_text}\n\n{self.answer_prompt}"}
+            ]
+        }
+
+    def group_request(self, slokas, model=MODEL, max_tokens=None):
+        """
+        Build the Messages API parameters for several slokas in one request
+
+        Args:
+            slokas: List of sloka texts with potential OCR errors
+            model: Claude model id
+            max_tokens: Output token budget per sloka (default depends on the task)
+
+        Returns:
+            Dictionary of keyword arguments for messages.create
+        """
+        return {
+            "model": model,
+            "max_tokens": (max_tokens or self.default_max_tokens) * len(slokas),
+            "system": cached_system(self.group_instructions),
+            "messages": [
+                {"role": "user",
+                 "content": f"Original slokas:\n{numbered_slokas(slokas)}\n\nReturn the JSON list:"}
+            ]
+        }
+
+    def cache_key(self, sloka_text, model=MODEL, max_tokens=None):
+        """
+        Cache key for the result of one sloka
+
+        The result may come from a single-sloka or a group request, so the key
+        covers both prompts and editing either one invalidates it.
+        """
+        return [self.request(sloka_text, model, max_tokens),
+                self.group_request([sloka_text], model, max_tokens)]
+
+    def lookup(self, cache, sloka_text, model=MODEL, max_tokens=None):
+        """
+        Result for a sloka that is known without asking Claude, or None
+        """
+        if not cache:
+            return None
+        cached = cache.get(self.cache_key(sloka_text, model, max_tokens))
+        if cached is None:
+            return None
+        try:
+            return self.check(self.decode(cached))
+        except ValueError:
+            # Cached before results were checked; ask Claude again
+            return None
+
+    def store(self, cache, sloka_text, result, model=MODEL, max_tokens=None):
+        if cache and self.cacheable(result):
+            cache.put(self.cache_key(sloka_text, model, max_tokens), self.encode(result))
+
+    def load(self, response_text):
+        """
+        Read Claude's answer for a single sloka; raises ValueError if it is
+        not usable
+        """
+        return self.check(json_loads(strip_code_fence(response_text)))
+
+    def load_group(self, response_text, count):
+        """
+        Read Claude's JSON list answer for a group of slokas; raises
+        ValueError if it cannot be matched up with the slokas
+        """
+        results = json_loads(strip_code_fence(response_text))
+        if not isinstance(results, list) or len(results) != count:
+            raise ValueError(f"Expected a JSON list of {count} results")
+        return [self.check(result) for result in results]
+
+    def cacheable(self, result):
+        return True
+
+    def encode(self, result):
+        return json.dumps(result, ensure_ascii=False)
+
+    def decode(self, value):
+        return json_loads(value)
+
+
+class Correction(SlokaTask):
+    """
+    Correct OCR errors in slokas; each result is the corrected sloka text
+    """
+
+    verb = 'correcting'
+    instructions = CORRECTION_INSTRUCTIONS
+    group_instructions = CORRECTION_GROUP_INSTRUCTIONS
+    answer_prompt = 'Corrected sloka:'
+    default_max_tokens = CORRECTION_MAX_TOKENS
+    batch_prefix = 'corr'
+
+    def __init__(self, skip_clean=False):
+        # Keep slokas that look clean as-is without calling Claude (--skip-clean)
+        self.skip_clean = skip_clean
+
+    def lookup(self, cache, sloka_text, model=MODEL, max_tokens=None):
+        if self.skip_clean and looks_clean(sloka_text):
+            return sloka_text
+        return super().lookup(cache, sloka_text, model, max_tokens)
+
+    def load(self, response_text):
+        return self.check(response_text)
+
+    def check(self, result):
+        if not isinstance(result, str):
+            raise ValueError("Expected the corrected sloka text")
+        return result.strip()
+
+    def failed(self, sloka_text, error, raw=None):
+        # Keep the OCR text
+        return sloka_text
+
+    def encode(self, result):
+        return result
+
+    def decode(self, value):
+        return value
+
+
+class Processing(SlokaTask):
+    """
+    Correct OCR errors in slokas and parse them into dictionary entries in one
+    request; each result is a dictionary with the corrected sloka
+    ('corrected', if Claude returned one) and the parsed entries ('entries')
+    """
+
+    verb = 'processing'
+    instructions = PROCESS_INSTRUCTIONS
+    group_instructions = PROCESS_GROUP_INSTRUCTIONS
+    answer_prompt = 'Return the JSON:'
+    default_max_tokens = PROCESS_MAX_TOKENS
+    batch_prefix = 'sloka'
+
+    def check(self, result):
+        # Reject malformed results here, so they are logged for --retry-failed
+        # instead of failing later in yaml_entry
+        if not isinstance(result, dict):
+            raise ValueError("Expected a JSON object")
+        if not isinstance(result.get('corrected') or '', str):
+            raise ValueError("Expected 'corrected' to be the sloka text")
+        entries = result.get('entries')
+        if not isinstance(entries, list) or not all(isinstance(e, dict) for e in entries):
+            raise ValueError("Expected 'entries' to be a list of objects")
+        return result
+
+    def failed(self, sloka_text, error, raw=None):
+        # Empty entries, plus the details for the failed-slokas log
+        return {"entries": [], "error": str(error), "raw": raw}
+
+    def cacheable(self, result):
+        # Don't cache empty parses so they are retried on the next run
+        return bool(result.get('entries'))
+
+
+def is_transient_error(exception):
+    """
+    Check whether a failed Claude request is worth retrying: rate limits
+    (429), server errors and overload (5xx/529) and connection failures
+    """
+    if isinstance(exception, APIStatusError):
+        return exception.status_code == 429 or exception.status_code >= 500
+    return isinstance(exception, APIConnectionError)
+
+
+# Exponential backoff for transient errors; the Vertex client is created with
+# max_retries=0 so the SDK's own retries don't multiply these attempts
+retry_transient = retry(
+    retry=retry_if_exception(is_transient_error),
+    wait=wait_exponential(min=2, max=60),
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+
+
+def request_timeout(max_tokens):
+    """
+    Timeout for a request that may generate up to max_tokens tokens
+
+    Args:
+        max_tokens: Output token budget of the request
+
+    Returns:
+        Timeout with the read timeout extended for the output budget
+    """
+    read = REQUEST_TIMEOUT.read + max_tokens / MIN_OUTPUT_TOKENS_PER_SECOND
+    return Timeout(read, connect=REQUEST_TIMEOUT.connect)
+
+
+@retry_transient
+async def create_message(client, sem, params):
+    """
+    Send one Messages API request, retrying transient errors
+
+    Args:
+        client: Async Anthropic Vertex AI client
+        sem: asyncio.Semaphore limiting concurrent requests (released while
+            waiting to retry)
+        params: Keyword arguments for messages.create
+
+    Returns:
+        The Message response
+    """
+    async with sem:
+        return await client.messages.create(**params,
+                                            timeout=request_timeout(params["max_tokens"]))
+
+
+def response_text(message):
+    """
+    Text of a Messages API response; raises ValueError if it was cut off
+
+    Args:
+        message: The Message response (or a succeeded batch result's message)
+
+    Returns:
+        The response text
+    """
+    if message.stop_reason == "max_tokens":
+        # A truncated answer would pass for a complete (but shortened) sloka,
+        # so treat it as a failure and never cache it
+        raise ValueError(f"Response hit the {message.usage.output_tokens} output token limit")
+    return message.content[0].text
+
+
+@retry_transient
+async def warm_up_client(client, model=MODEL):
+    """
+    Send a minimal request so credentials are loaded and a connection is
+    established before the real requests start
+
+    Args:
+        client: Async Anthropic Vertex AI client
+        model: Claude model id
+    """
+    await client.messages.create(
+        model=model,
+        max_tokens=1,
+        messages=[{"role": "user", "content": "ping"}]
+    )
+
+
+async def ask_sloka(task, sloka_text, client, sem, cache=None, model=MODEL, max_tokens=None):
+    """
+    Ask Claude about one sloka on its own (unless its result is cached)
+
+    Args:
+        task: SlokaTask describing the request
+        sloka_text: The sloka text with potential OCR errors
+        client: Async Anthropic Vertex AI client
+        sem: asyncio.Semaphore limiting concurrent requests
+        cache: Optional ResponseCache
+        model: Claude model id
+        max_tokens: Output token budget (default depends on the task)
+
+    Returns:
+        The task's result for the sloka, or its failed() result
+    """
+    result = task.lookup(cache, sloka_text, model, max_tokens)
+    if result is not None:
+        return result
+
+    raw = None
+    try:
+        message = await create_message(client, sem, task.request(sloka_text, model, max_tokens))
+        raw = message.content[0].text
+        result = task.load(response_text(message))
+    except Exception as e:
+        tqdm.write(f"Error {task.verb} sloka: {e}\n  {sloka_text}")
+        return task.failed(sloka_text, e, raw)
+
+    task.store(cache, sloka_text, result, model, max_tokens)
+    return result
+
+
+async def ask_group(task, slokas, client, sem, cache=None, model=MODEL, max_tokens=None):
+    """
+    Ask Claude about several slokas in a single request, skipping cached ones
+
+    Falls back to one request per sloka if the group answer cannot be matched
+    up with the slokas; if the request itself fails, every pending sloka gets
+    the task's failed() result.
+
+    Args:
+        task: SlokaTask describing the request
+        slokas: List of sloka texts with potential OCR errors
+        client: Async Anthropic Vertex AI client
+        sem: asyncio.Semaphore limiting concurrent requests
+        cache: Optional ResponseCache
+        model: Claude model id
+        max_tokens: Output token budget per sloka (default depends on the task)
+
+    Returns:
+        List of the task's results in input order
+    """
+    results = [task.lookup(cache, sloka, model, max_tokens) for sloka in slokas]
+    pending = [i for i, result in enumerate(results) if result is None]
+
+    if len(pending) > 1:
+        group = [slokas[i] for i in pending]
+        try:
+            message = await create_message(client, sem,
+                                           task.group_request(group, model, max_tokens))
+            answers = task.load_group(response_text(message), len(group))
+        except ValueError as e:
+            # The answer could not be matched up with the slokas
+            tqdm.write(f"Error {task.verb} slokas together, retrying one by one: {e}")
+        except Exception as e:
+            # The request itself failed (create_message already retried
+            # transient errors), so resending each sloka would only multiply
+            # the requests, e.g. while rate limited
+            tqdm.write(f"Error {task.verb} slokas: {e}")
+            for i in pending:
+                results[i] = task.failed(slokas[i], e)
+            pending = []
+        else:
+            for i, result in zip(pending, answers):
+                results[i] = result
+                task.store(cache, slokas[i], result, model, max_tokens)
+            pending = []
+
+    answers = await asyncio.gather(
+        *[ask_sloka(task, slokas[i], client, sem, cache, model, max_tokens) for i in pending]
+    )
+    for i, result in zip(pending, answers):
+        results[i] = result
+    return results
+
+
+async def run_batch(client, requests, prefix, timeout, poll_interval=30):
+    """
+    Submit requests through the Message Batches API and wait for the results
+
+    The Batch API is billed at half the price of regular requests but is not
+    available on Vertex AI, so this uses the direct Anthropic API client.
+
+    Args:
+        client: Async Anthropic API client (uses ANTHROPIC_API_KEY)
+        requests: List of messages.create keyword argument dictionaries
+        prefix: Prefix for the custom_id of each request (e.g. 'corr')
+        timeout: Seconds to wait for the batch before giving up
+        poll_interval: Seconds between status checks
+
+    Returns:
+        List of response texts in request order (None for requests that
+        failed or were cut off), or None if the batch could not be completed in time
+    """
+    batch_requests = []
+    for i, params in enumerate(requests):
+        # Vertex AI model ids use '@' before the date, the Anthropic API uses '-'
+        params = {**params, "model": params["model"].replace('@', '-')}
+        batch_requests.append({"custom_id": f"{prefix}-{i}", "params": params})
+
+    try:
+        batch = await client.messages.batches.create(requests=batch_requests)
+        tqdm.write(f"Submitted batch {batch.id} with {len(batch_requests)} requests")
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while batch.processing_status != "ended":
+            if loop.time() >= deadline:
+                tqdm.write(f"Batch {batch.id} did not finish within {timeout}s, cancelling...")
+                await client.messages.batches.cancel(batch.id)
+                return None
+            await asyncio.sleep(poll_interval)
+            batch = await client.messages.batches.retrieve(batch.id)
+
+        texts = [None] * len(batch_requests)
+        async for entry in await client.messages.batches.results(batch.id):
+            if entry.result.type == "succeeded":
+                index = int(entry.custom_id.rsplit('-', 1)[1])
+                try:
+                    texts[index] = response_text(entry.result.message).strip()
+                except ValueError as e:
+                    # Leave it None so the request is retried like a failed one
+                    tqdm.write(f"Error in batch request {entry.custom_id}: {e}")
     except Exception as e:
-        print(f"Error parsing sloka: {e}")
-        return {"entries": []}
+        tqdm.write(f"Error running batch: {e}")
+        return None
+
+    failed = texts.count(None)
+    if failed:
+        tqdm.write(f"Warning: {failed} batch requests did not succeed")
+    return texts
+
+
+async def ask_batch(task, slokas, batch_client, cache=None, batch_timeout=3600, model=MODEL,
+                    max_tokens=None):
+    """
+    Ask Claude about slokas through the Message Batches API, skipping cached
+    ones
+
+    Args:
+        task: SlokaTask describing the request
+        slokas: List of sloka texts
+        batch_client: Async Anthropic API client for the Batch API
+        cache: Optional ResponseCache
+        batch_timeout: Seconds to wait for the batch
+        model: Claude model id
+        max_tokens: Output token budget (default depends on the task)
+
+    Returns:
+        List of the task's results in input order, with None for slokas to
+        send as regular requests instead (all of them if the batch failed)
+    """
+    results = [task.lookup(cache, sloka, model, max_tokens) for sloka in slokas]
+    pending = [i for i, result in enumerate(results) if result is None]
+    if not pending:
+        return results
+
+    tqdm.write(f"{task.verb.capitalize()} {len(pending)} slokas via the Message Batches API...")
+    requests = [task.request(slokas[i], model, max_tokens) for i in pending]
+    texts = await run_batch(batch_client, requests, task.batch_prefix, batch_timeout)
+    if texts is None:
+        tqdm.write("Falling back to regular requests...")
+        return results
+
+    for i, text in zip(pending, texts):
+        if text is None:
+            continue
+        try:
+            results[i] = task.load(text)
+        except ValueError as e:
+            tqdm.write(f"Error {task.verb} sloka (retrying as a regular request): {e}\n"
+                       f"  {slokas[i]}")
+            continue
+        task.store(cache, slokas[i], results[i], model, max_tokens)
+    return results
+
+
+async def ask_slokas(task, slokas, client, sem, cache=None, batch_client=None,
+                     batch_timeout=3600, model=MODEL, group_size=1, max_tokens=None):
+    """
+    Ask Claude about all slokas, via the Batch API if a batch client is given
+    and concurrent Vertex AI requests for the rest
+
+    Args:
+        task: SlokaTask describing the request
+        slokas: List of sloka texts
+        client: Async Anthropic Vertex AI client
+        sem: asyncio.Semaphore limiting concurrent requests
+        cache: Optional ResponseCache
+        batch_client: Optional async Anthropic API client for the Batch API
+        batch_timeout: Seconds to wait for a batch before falling back
+        model: Claude model id
+        group_size: Slokas per regular request
+        max_tokens: Output token budget per sloka (default depends on the task)
+
+    Returns:
+        List of the task's results in input order
+    """
+    results = [None] * len(slokas)
+    if batch_client:
+        results = await ask_batch(task, slokas, batch_client, cache, batch_timeout, model,
+                                  max_tokens)
+
+    pending = [i for i, result in enumerate(results) if result is None]
+    if pending:
+        # Send the remaining slokas in concurrent groups; gather preserves input order
+        groups = [pending[k:k + group_size] for k in range(0, len(pending), group_size)]
+        with tqdm(total=len(groups), desc=f"{task.verb.capitalize()} {len(pending)} slokas",
+                  unit="request") as progress:
+            async def ask(group):
+                try:
+                    return await ask_group(task, [slokas[i] for i in group], client, sem, cache,
+                                           model, max_tokens)
+                finally:
+                    progress.update()
+
+            # tqdm_asyncio.gather only takes return_exceptions from tqdm 4.69 on
+            answers = await asyncio.gather(*[ask(group) for group in groups],
+                                           return_exceptions=True)
+        for group, group_results in zip(groups, answers):
+            if isinstance(group_results, BaseException):
+                tqdm.write(f"Error {task.verb} slokas: {group_results}")
+                group_results = [task.failed(slokas[i], group_results) for i in group]
+            for i, result in zip(group, group_results):
+                results[i] = result
+
+    return results
+
+
+async def stream_slokas(pdf_path, lang, handle, workers, ocr_workers=1, group_size=1,
+                        on_result=None):
+    """
+    OCR a PDF page by page in a background thread and hand each sloka to a
+    pool of async workers as soon as it is extracted, so OCR time overlaps
+    with Claude latency instead of running before it
+
+    Args:
+        pdf_path: Path to input PDF file
+        lang: Language code for Tesseract
+        handle: Async function called with a list of slokas, returning their
+            results in order
+        workers: Number of concurrent workers
+        ocr_workers: Number of pages to OCR in parallel
+        group_size: Maximum slokas per handle call; a worker only groups
+            slokas that are already waiting, so it never delays one for another
+        on_result: Optional function called with (index, sloka, result) as
+            soon as each sloka is handled; the results are then not kept
+
+    Returns:
+        List of (sloka, result) tuples in source order, or with on_result
+        just the sloka texts
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    results = {}
+
+    def produce():
+        seen = set()
+        try:
+            lines = (line for text in iter_page_texts(pdf_path, lang, ocr_workers)
+                     for line in text.split('\n'))
+            for sloka in iter_slokas(lines):
+                # Identical slokas would collapse into a single YAML key anyway
+                if sloka in seen:
+                    continue
+                loop.call_soon_threadsafe(queue.put_nowait, (len(seen), sloka))
+                seen.add(sloka)
+            tqdm.write(f"OCR complete: found {len(seen)} slokas")
+        finally:
+            for _ in range(workers):
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            group = [item]
+            while len(group) < group_size and not queue.empty():
+                item = queue.get_nowait()
+                if item is None:
+                    # Leave the end-of-input sentinel for the next get
+                    queue.put_nowait(None)
+                    break
+                group.append(item)
+
+            outputs = await handle([sloka for _, sloka in group])
+            for (index, sloka), result in zip(group, outputs):
+                if on_result:
+                    # Don't hold on to results the caller has already written
+                    results[index] = sloka
+                    on_result(index, sloka, result)
+                else:
+                    results[index] = (sloka, result)
+
+    await asyncio.gather(asyncio.to_thread(produce), *[worker() for _ in range(workers)])
+    return [results[index] for index in sorted(results)]
+
+
+def dump_sloka_yaml(sloka, value, f):
+    """
+    Write one sloka and its metadata to an open YAML file, producing exactly
+    the same text as a single yaml.dump of the whole dictionary
+
+    Args:
+        sloka: Sloka text (the YAML key)
+        value: Metadata dictionary for the sloka
+        f: Output file opened for writing
+    """
+    yaml.dump({sloka: value}, f, Dumper=SafeDumper, allow_unicode=True,
+              default_flow_style=False, sort_keys=False, indent=2, width=float('inf'))
+
+
+def merge_retried(output_path, slokas, results, failures=None):
+    """
+    Replace retried slokas in an existing output YAML with their new results,
+    keeping each sloka at its original position
+
+    A sloka whose enrichment failed was written under its normalized OCR
+    text, which is how it is found again here.
+
+    Args:
+        output_path: Output YAML file to update
+        slokas: List of retried OCR sloka texts
+        results: List of result dictionaries ('corrected' and 'entries')
+        failures: Optional FailureLog for slokas that failed again
+    """
+    data = {}
+    if Path(output_path).exists():
+        with open(output_path, encoding='utf-8') as f:
+            data = yaml.safe_load(f) or {}
+
+    retried = {}
+    for sloka, result in zip(slokas, results):
+        if failures and 'error' in result:
+            failures.add(sloka, result.get('raw'), result['error'])
+        retried[normalize_sloka(sloka)] = yaml_entry(sloka, result)
+
+    written = set()
+    with open(output_path, 'w', encoding='utf-8') as f:
+        def write(key, value):
+            # A corrected sloka may now match another sloka's key
+            if key not in written:
+                written.add(key)
+                dump_sloka_yaml(key, value, f)
+
+        for key, value in data.items():
+            write(*retried.pop(key, (key, value)))
+        # Slokas missing from the output (e.g. it was regenerated) go at the end
+        for key, value in retried.values():
+            write(key, value)
+
+
+def normalize_sloka(sloka_text):
+    """
+    Normalize a corrected sloka to the single-line form used as a YAML key
+
+    Args:
+        sloka_text: Corrected sloka text
+
+    Returns:
+        Normalized sloka text
+    """
+    # Collapse newlines and repeated spaces into single spaces, then replace
+    # ।। (two single dandas) with ॥ (proper double danda)
+    return WS_RE.sub(' ', sloka_text).replace('।।', '॥').strip()
+
+
+class FailureLog:
+    """
+    JSON lines file of slokas whose enrichment failed, with Claude's raw
+    response and the error, so they can be reprocessed with --retry-failed
+
+    The file is only created once a sloka fails; a log left by an earlier
+    run is removed so it never describes a different run. With
+    replace_on_close (for --retry-failed, which reads that log) the new log is
+    written beside it and only replaces it in close(), so an interrupted
+    retry keeps the old one.
+    """
+
+    def __init__(self, path, replace_on_close=False):
+        self.path = path
+        self.write_path = path + '.tmp' if replace_on_close else path
+        self.f = None
+        self.count = 0
+        if not replace_on_close:
+            Path(path).unlink(missing_ok=True)
+
+    def add(self, sloka, raw, error):
+        if self.f is None:
+            self.f = open(self.write_path, 'w', encoding='utf-8')
+        record = {"sloka": sloka, "raw": raw, "error": error}
+        self.f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.f.flush()
+        self.count += 1
+
+    def close(self):
+        if self.f:
+            self.f.close()
+        if self.write_path != self.path:
+            if self.f:
+                os.replace(self.write_path, self.path)
+            else:
+                Path(self.path).unlink(missing_ok=True)
+                # Left behind by an interrupted retry
+                Path(self.write_path).unlink(missing_ok=True)
 
 
-def main():
+def read_failed(path):
+    """
+    Read the slokas recorded in a failed-slokas log (see FailureLog)
+
+    Args:
+        path: Path to the JSON lines file
+
+    Returns:
+        List of OCR sloka texts, without duplicates
+    """
+    with open(path, encoding='utf-8') as f:
+        return list(dict.fromkeys(json_loads(line)['sloka'] for line in f if line.strip()))
+
+
+class YamlWriter:
+    """
+    Append slokas to the output YAML as they finish, in source order, so an
+    interrupted run keeps every sloka completed before it (and a re-run gets
+    the rest from the response cache)
+
+    Results can arrive out of order; each one is held until all slokas before
+    it have been written.
+    """
+
+    def __init__(self, f, enriched=True, failures=None):
+        self.f = f
+        self.enriched = enriched
+        self.failures = failures
+        self.next_index = 0
+        self.waiting = {}
+        self.written = set()
+
+    def add(self, index, sloka, result):
+        self.waiting[index] = (sloka, result)
+        while self.next_index in self.waiting:
+            sloka, result = self.waiting.pop(self.next_index)
+            self.next_index += 1
+            if self.failures and self.enriched and 'error' in result:
+                self.failures.add(sloka, result.get('raw'), result['error'])
+            key, value = yaml_entry(sloka, result, self.enriched)
+            # Slokas that became identical after correction share one YAML key
+            if key in self.written:
+                continue
+            self.written.add(key)
+            dump_sloka_yaml(key, value, self.f)
+        self.f.flush()
+
+
+def yaml_entry(sloka, result, enriched=True):
+    """
+    Build the YAML key and metadata for a processed sloka
+
+    Args:
+        sloka: Sloka text from OCR
+        result: Corrected sloka text, or with enrichment the result dictionary
+            ('corrected' and 'entries')
+        enriched: Whether result comes from correction plus parsing
+
+    Returns:
+        Tuple of (normalized corrected sloka, metadata dictionary)
+    """
+    if not enriched:
+        return normalize_sloka(result), {}
+
+    corrected = normalize_sloka(result.pop('corrected', None) or sloka)
+    # Failure details belong in the failed-slokas log, not the YAML
+    result.pop('error', None)
+    result.pop('raw', None)
+
+    # Add verify: false right after head for proofreading tracking
+    # ('head' keeps its leading position when **entry re-adds it)
+    result['entries'] = [
+        {'head': entry['head'], 'verify': False, **entry} if 'head' in entry else entry
+        for entry in result.get('entries', [])
+    ]
+    return corrected, result
+
+
+async def main():
     parser = argparse.ArgumentParser(
         description='Convert Sanskrit PDF to enriched YAML (OCR + AI correction + enrichment)',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -177,17 +1058,35 @@ Examples:
     --title "लोकपालाध्यायः" \\
     --khanda "स्वर्गकाण्डः"
 
+  # Use the Message Batches API (half price, results may take longer)
+  python pdf_to_corrected_yaml.py \\
+    Input/Vaijayanti_Kosha/1_SvargaKhanda/2_Lokapaaladhyayah.pdf \\
+    -o Output/Vaijayanti_Kosha/1_SvargaKhanda/2_Lokapaaladhyayah.yaml \\
+    --project-id my-project --use-batch
+
   # Skip enrichment step (only OCR + correction)
   python pdf_to_corrected_yaml.py \\
     Input/Vaijayanti_Kosha/1_SvargaKhanda/1_AdiDevaadhyaayah.pdf \\
     -o Output/Vaijayanti_Kosha/1_SvargaKhanda/1_AdiDevaadhyaayah.yaml \\
     --project-id my-project --skip-enrichment
 
+  # Reprocess only the slokas whose enrichment failed, with a stronger model
+  python pdf_to_corrected_yaml.py \\
+    -o Output/Vaijayanti_Kosha/1_SvargaKhanda/2_Lokapaaladhyayah.yaml \\
+    --project-id my-project --model claude-sonnet-4-5@20250929 \\
+    --retry-failed Output/Vaijayanti_Kosha/1_SvargaKhanda/2_Lokapaaladhyayah.yaml.failed.jsonl
+
+  # Try a prompt or model change on 20 random slokas
+  python pdf_to_corrected_yaml.py \\
+    Input/Vaijayanti_Kosha/1_SvargaKhanda/1_AdiDevaadhyaayah.pdf \\
+    -o /tmp/sample.yaml --project-id my-project --sample 20 --max-tokens 2048
+
 Note: This script combines OCR, AI correction, and enrichment in a single step.
         """
     )
 
-    parser.add_argument('input_pdf', help='Input PDF file path')
+    parser.add_argument('input_pdf', nargs='?',
+                        help='Input PDF file path (not needed with --retry-failed)')
     parser.add_argument('-o', '--output', required=True,
                         help='Output enriched YAML file path')
     parser.add_argument('--project-id', required=True,
@@ -200,39 +1099,84 @@ Note: This script combines OCR, AI correction, and enrichment in a single step.
                         help='Name of the khanda')
     parser.add_argument('-l', '--lang', default='san',
                         help='Language code for OCR (default: san for Sanskrit)')
+    parser.add_argument('--ocr-concurrency', type=int, default=os.cpu_count() or 1,
+                        help='Number of PDF pages to OCR in parallel (default: CPU count)')
     parser.add_argument('--skip-enrichment', action='store_true',
                         help='Skip the enrichment step (only OCR + correction)')
+    parser.add_argument('--skip-clean', action='store_true',
+                        help='With --skip-enrichment, keep slokas that already look clean '
+                             '(Devanagari only, one । and a closing ॥) without asking Claude')
+    parser.add_argument('--model', default=MODEL,
+                        help=f'Claude model id on Vertex AI (default: {MODEL})')
+    parser.add_argument('--max-tokens', type=int,
+                        help=f'Output token budget per sloka (default: {PROCESS_MAX_TOKENS}, '
+                             f'or {CORRECTION_MAX_TOKENS} with --skip-enrichment)')
+    parser.add_argument('--sample', type=int, default=0,
+                        help='Process only N randomly chosen slokas (fixed seed), e.g. to '
+                             'compare prompts or models; OCRs the whole PDF first')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='Maximum number of concurrent Claude requests (default: 10)')
+    parser.add_argument('--group-size', type=int,
+                        help=f'Slokas sent to Claude per request (default: {PROCESS_GROUP_SIZE}, '
+                             f'or {CORRECTION_GROUP_SIZE} with --skip-enrichment; 1 sends each '
+                             f'sloka on its own)')
+    parser.add_argument('--use-batch', action='store_true',
+                        help='Use the Message Batches API (Anthropic API, 50%% cheaper; '
+                             'requires ANTHROPIC_API_KEY)')
+    parser.add_argument('--batch-timeout', type=int, default=3600,
+                        help='Seconds to wait for a batch before falling back to '
+                             'regular requests (default: 3600)')
+    parser.add_argument('--cache', default='.claude_cache.db',
+                        help='SQLite file caching Claude results between runs '
+                             '(default: .claude_cache.db)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always call Claude, ignoring and not updating the cache')
+    parser.add_argument('--retry-failed', metavar='FILE',
+                        help='Reprocess only the slokas logged in FILE (OUTPUT.failed.jsonl '
+                             'from an earlier run) and update them in the output YAML')
 
     args = parser.parse_args()
+    if args.skip_clean and not args.skip_enrichment:
+        parser.error('--skip-clean requires --skip-enrichment (enrichment needs a request per sloka)')
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    if args.ocr_concurrency < 1:
+        parser.error('--ocr-concurrency must be at least 1')
+    if args.group_size is not None and args.group_size < 1:
+        parser.error('--group-size must be at least 1')
+    if args.max_tokens is not None and args.max_tokens < 1:
+        parser.error('--max-tokens must be at least 1')
+    if args.sample < 0:
+        parser.error('--sample must not be negative')
+    if args.retry_failed and args.skip_enrichment:
+        parser.error('--retry-failed reprocesses enrichment failures, so it cannot be '
+                     'combined with --skip-enrichment')
+    if not args.retry_failed and not args.input_pdf:
+        parser.error('input_pdf is required unless --retry-failed is given')
+    group_size = args.group_size or (CORRECTION_GROUP_SIZE if args.skip_enrichment
+                                     else PROCESS_GROUP_SIZE)
 
     # Check if input file exists
-    if not Path(args.input_pdf).exists():
-        print(f"Error: Input file not found: {args.input_pdf}")
+    input_path = args.retry_failed or args.input_pdf
+    if not Path(input_path).exists():
+        print(f"Error: Input file not found: {input_path}")
         sys.exit(1)
 
     print("=" * 80)
     print("SANSKRIT PDF TO ENRICHED YAML PIPELINE")
     print("=" * 80)
 
-    # Step 1: Extract text from PDF using OCR
-    print("\n[1/5] Running OCR on PDF...")
-    text_content = pdf_to_text(args.input_pdf, args.lang)
-
-    # Step 2: Extract slokas from text
-    print("\n[2/5] Extracting slokas from OCR text...")
-    slokas = extract_slokas(text_content)
-    print(f"Found {len(slokas)} slokas")
-
-    # Step 3: Create temporary YAML structure
-    print("\n[3/5] Creating temporary YAML structure...")
-    yaml_data = create_yaml_output(slokas, args.title, args.khanda)
-
-    # Step 4: Correct OCR errors with Claude
-    print("\n[4/5] Correcting OCR errors with Claude AI...")
+    # Initialize clients up front so Claude requests can start as soon as OCR
+    # produces the first sloka
     print(f"Initializing Vertex AI client (region: {args.region})...")
 
     try:
-        client = AnthropicVertex(region=args.region, project_id=args.project_id)
+        # One client (and so one HTTP connection pool) is shared by every request
+        client = AsyncAnthropicVertex(region=args.region, project_id=args.project_id,
+                                      timeout=REQUEST_TIMEOUT, max_retries=0)
+        # Load credentials and open the first connection before OCR starts, so
+        # auth or model access problems fail fast instead of after OCR
+        await warm_up_client(client, args.model)
     except Exception as e:
         print(f"\nError: Failed to initialize Vertex AI client: {e}")
         print("\nMake sure you have:")
@@ -240,71 +1184,100 @@ Note: This script combines OCR, AI correction, and enrichment in a single step.
         print("2. Enabled Claude models in Vertex AI Model Garden")
         sys.exit(1)
 
-    # Correct each sloka
-    corrected_data = {}
-    total = len(yaml_data)
-    for i, (sloka, metadata) in enumerate(yaml_data.items(), 1):
-        print(f"Correcting sloka {i}/{total}...", end='\r')
-        corrected_sloka = correct_sloka_with_claude(sloka, client)
+    sem = asyncio.Semaphore(args.concurrency)
+    batch_client = AsyncAnthropic() if args.use_batch else None
+    cache = None if args.no_cache else ResponseCache(args.cache)
 
-        # Remove any newlines to ensure single-line format
-        corrected_sloka = corrected_sloka.replace('\n', ' ')
-        # Clean up multiple spaces
-        corrected_sloka = ' '.join(corrected_sloka.split())
-        # Normalize double danda: replace ।। (two singles) with ॥ (proper double)
-        corrected_sloka = corrected_sloka.replace('।।', '॥')
+    task = Correction(args.skip_clean) if args.skip_enrichment else Processing()
 
-        corrected_data[corrected_sloka] = {}
+    failed_path = args.output + '.failed.jsonl'
+    if args.retry_failed:
+        slokas = read_failed(args.retry_failed)
+        # The log is only replaced with this run's failures once the YAML is
+        # updated (failures.close() below)
+        failures = FailureLog(failed_path, replace_on_close=True)
+        print(f"\nRetrying {len(slokas)} failed slokas from: {args.retry_failed}")
+        results = await ask_slokas(task, slokas, client, sem, cache, batch_client,
+                                   args.batch_timeout, args.model, group_size, args.max_tokens)
+        print(f"Updating YAML: {args.output}")
+        merge_retried(args.output, slokas, results, failures)
+    else:
+        failures = None if args.skip_enrichment else FailureLog(failed_path)
 
-    print(f"\nCompleted correction of {total} slokas")
+        # Open the output up front and append each sloka as soon as it (and every
+        # sloka before it) is done, so an interrupted run keeps its finished work
+        output_path = Path(args.output)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        print(f"Writing YAML to: {args.output}")
 
-    # Step 5: Enrich with metadata (if not skipped)
-    if not args.skip_enrichment:
-        print("\n[5/5] Enriching with semantic metadata...")
-        enriched_data = {}
-
-        for i, (sloka, metadata) in enumerate(corrected_data.items(), 1):
-            print(f"Parsing sloka {i}/{total}...", end='\r')
-
-            parsed = parse_sloka_with_claude(sloka, client)
-
-            # Add verify: false right after head for proofreading tracking
-            for entry in parsed.get('entries', []):
-                if 'head' in entry:
-                    # Create ordered dict with verify right after head
-                    new_entry = {'head': entry['head'], 'verify': False}
-                    # Add remaining fields
-                    for key, value in entry.items():
-                        if key != 'head':
-                            new_entry[key] = value
-                    # Replace entry with ordered version
-                    entry.clear()
-                    entry.update(new_entry)
-
-            enriched_data[sloka] = parsed
-
-        print(f"\nCompleted enrichment of {total} slokas")
-        final_data = enriched_data
-    else:
-        print("\n[5/5] Skipping enrichment step...")
-        final_data = corrected_data
+        with open(args.output, 'w', encoding='utf-8') as f:
+            writer = YamlWriter(f, enriched=not args.skip_enrichment, failures=failures)
+
+            if args.use_batch or args.sample:
+                # The Batch API and sampling need every sloka up front, so run the
+                # stages in turn
+                # Step 1: Extract text from PDF using OCR
+                print("\n[1/3] Running OCR on PDF...")
+                text_content = pdf_to_text(args.input_pdf, args.lang, args.ocr_concurrency)
+
+                # Step 2: Extract slokas from text
+                print("\n[2/3] Extracting slokas from OCR text...")
+                slokas = list(create_yaml_output(extract_slokas(text_content), args.title, args.khanda))
+                print(f"Found {len(slokas)} slokas")
+                if args.sample:
+                    # Keep the sampled slokas in source order
+                    picked = random.Random(SAMPLE_SEED).sample(range(len(slokas)),
+                                                               min(args.sample, len(slokas)))
+                    slokas = [slokas[i] for i in sorted(picked)]
+                    print(f"Sampled {len(slokas)} slokas")
+
+                # Step 3: Correct OCR errors (and enrich) with Claude
+                print("\n[3/3] Correcting OCR errors with Claude AI...")
+                results = await ask_slokas(task, slokas, client, sem, cache, batch_client,
+                                           args.batch_timeout, args.model, group_size,
+                                           args.max_tokens)
+                for index, (sloka, result) in enumerate(zip(slokas, results)):
+                    writer.add(index, sloka, result)
+            else:
+                # OCR pages and send each sloka to Claude as soon as it is found
+                print("\nRunning OCR and Claude AI correction concurrently...")
+                async def handle(group):
+                    return await ask_group(task, group, client, sem, cache, args.model,
+                                           args.max_tokens)
+
+                # The sloka count is only known once OCR finishes, so the bar has no total
+                with tqdm(desc="Slokas", unit="sloka") as progress:
+                    def on_result(index, sloka, result):
+                        writer.add(index, sloka, result)
+                        progress.update()
+
+                    slokas = await stream_slokas(args.input_pdf, args.lang, handle,
+                                                 args.concurrency, args.ocr_concurrency,
+                                                 group_size, on_result)
 
-    # Write final YAML
-    output_path = Path(args.output)
-    output_path.parent.mkdir(parents=True, exist_ok=True)
+    if cache:
+        cache.close()
+    if failures:
+        failures.close()
 
-    print(f"\nWriting final YAML to: {args.output}")
-    with open(args.output, 'w', encoding='utf-8') as f:
-        yaml.dump(final_data, f, allow_unicode=True, default_flow_style=False,
-                  sort_keys=False, indent=2, width=float('inf'))
+    total = len(slokas)
+    print(f"Completed {total} slokas")
+    if args.skip_clean:
+        skipped = sum(1 for sloka in slokas if looks_clean(sloka))
+        print(f"Skipped correction of {skipped}/{total} slokas that looked clean")
 
     print("\n" + "=" * 80)
-    print(f"✓ Successfully created YAML with {total} slokas")
+    print(f"✓ Successfully {'updated' if args.retry_failed else 'created'} YAML "
+          f"with {total} slokas")
     if not args.skip_enrichment:
         print(f"✓ Enriched with semantic metadata (headwords, synonyms, genders)")
     print(f"✓ Output saved to: {args.output}")
+    if failures and failures.count:
+        print(f"⚠ {failures.count} slokas could not be parsed and have no entries; "
+              f"see {failed_path}")
+        print(f"  Reprocess only those with: --retry-failed {failed_path}")
     print("=" * 80)
 
 
 if __name__ == '__main__':
-    main()
+    asyncio.run(main())
@@ -4,22 +4,39 @@ PDF to YAML Converter for Sanskrit Texts
 Converts Sanskrit PDF pages to YAML format with slokas (without intermediate files)
 """
 
+import os
 import sys
 import argparse
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 import pytesseract
 import yaml
+from tqdm import tqdm
 
 
-def pdf_to_text(pdf_path, lang='san'):
+def limit_tesseract_threads(workers):
+    """
+    Stop parallel Tesseract processes from oversubscribing the CPU with their
+    own OpenMP threads (only when more than one page is OCR'd at a time)
+
+    Args:
+        workers: Number of pages OCR'd in parallel
+    """
+    if workers > 1:
+        os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+
+
+def pdf_to_text(pdf_path, lang='san', workers=1):
     """
     Convert PDF to text using OCR (in-memory, no intermediate file)
 
     Args:
         pdf_path: Path to input PDF file
         lang: Language code for Tesseract (default: 'san' for Sanskrit)
+        workers: Number of pages to OCR in parallel (each page runs its own
+            Tesseract process, so this scales with CPU cores)
 
     Returns:
         Extracted text as string
@@ -36,17 +53,54 @@ def pdf_to_text(pdf_path, lang='san'):
     print("\nStep 2: Extracting text from each page...")
     all_text = []
 
-    for i, image in enumerate(images, 1):
-        print(f"Processing page {i}/{len(images)}...", end='\r')
-        text = pytesseract.image_to_string(image, lang=lang)
-        all_text.append(text)
+    limit_tesseract_threads(workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        texts = executor.map(lambda image: pytesseract.image_to_string(image, lang=lang), images)
+        all_text.extend(tqdm(texts, total=len(images), desc="OCR", unit="page"))
 
-    print(f"\nProcessing complete! Extracted text from {len(images)} pages")
+    print(f"Processing complete! Extracted text from {len(images)} pages")
 
     # Combine all text
     return '\n'.join(all_text)
 
 
+def ocr_page(pdf_path, page, lang='san'):
+    """
+    Convert a single PDF page to an image and OCR it
+
+    Args:
+        pdf_path: Path to input PDF file
+        page: Page number (1-indexed)
+        lang: Language code for Tesseract (default: 'san' for Sanskrit)
+
+    Returns:
+        Extracted text of the page
+    """
+    image = convert_from_path(pdf_path, first_page=page, last_page=page)[0]
+    return pytesseract.image_to_string(image, lang=lang)
+
+
+def iter_page_texts(pdf_path, lang='san', workers=1):
+    """
+    OCR a PDF page by page, so callers can start working on early pages
+    before the whole PDF has been converted
+
+    Args:
+        pdf_path: Path to input PDF file
+        lang: Language code for Tesseract (default: 'san' for Sanskrit)
+        workers: Number of pages to OCR in parallel
+
+    Yields:
+        Extracted text of each page, in order
+    """
+    page_count = pdfinfo_from_path(pdf_path)['Pages']
+    limit_tesseract_threads(workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map() yields pages in order while later pages are still being OCR'd
+        yield from executor.map(lambda page: ocr_page(pdf_path, page, lang),
+                                range(1, page_count + 1))
+
+
 def extract_slokas(text_content):
     """
     Extract slokas from OCR text, removing verse numbers
@@ -58,8 +112,19 @@ def extract_slokas(text_content):
     Returns:
         List of sloka text strings
     """
-    slokas = []
-    lines = text_content.split('\n')
+    return list(iter_slokas(text_content.split('\n')))
+
+
+def iter_slokas(lines):
+    """
+    Incrementally extract slokas from lines of OCR text (see extract_slokas)
+
+    Args:
+        lines: Iterable of OCR text lines
+
+    Yields:
+        Sloka text strings as soon as their closing double danda is seen
+    """
     current_sloka = []
 
     for line in lines:
@@ -99,13 +164,11 @@ def extract_slokas(text_content):
 
                 # Only add if it has substantial content
                 if len(full_sloka) > 15:
-                    slokas.append(full_sloka)
+                    yield full_sloka
 
                 # Reset for next sloka
                 current_sloka = []
 
-    return slokas
-
 
 def create_yaml_output(slokas, title, khanda):
     """